@@ -19,6 +19,7 @@ N_GRAD = 'n_grad'  # number of gradient evaluations
 N_HESS = 'n_hess'  # number of Hessian evaluations
 N_RES = 'n_res'  # number of residual evaluations
 N_SRES = 'n_sres'  # number of residual sensitivity evaluations
+N_ITERATIONS = 'n_iterations'  # number of recorded iterations
 CHI2 = 'chi2'  # chi2 value
 SCHI2 = 'schi2'  # chi2 value gradient
 X = 'x'
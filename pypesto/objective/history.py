@@ -1,20 +1,29 @@
 import numpy as np
 import pandas as pd
+import h5py
+import base64
 import numbers
-import copy
+import functools
 import time
 import os
-import abc
 from typing import Any, Dict, List, Tuple, Sequence, Union
 
 from .constants import (
     MODE_FUN, MODE_RES, FVAL, GRAD, HESS, RES, SRES, CHI2, SCHI2, TIME,
-    N_FVAL, N_GRAD, N_HESS, N_RES, N_SRES, X)
+    N_FVAL, N_GRAD, N_HESS, N_RES, N_SRES, N_ITERATIONS, X)
 from .util import res_to_chi2, sres_to_schi2, sres_to_fim
 
 ResultDict = Dict[str, Union[float, np.ndarray]]
 MaybeArray = Union[np.ndarray, 'np.nan']
 
+# values that can be recorded in the trace
+TRACE_VARS = (FVAL, GRAD, HESS, RES, SRES, CHI2, SCHI2)
+
+# per-dataset raw data chunk cache of `Hdf5History` files. Large enough to
+# hold the 1 MB chunk of each trace dataset that is being filled, chunks
+# are written row by row and not touched again once full
+HDF5_CHUNK_CACHE = dict(rdcc_nbytes=4 * 2**20, rdcc_nslots=10007, rdcc_w0=1.)
+
 
 def trace_wrap(f):
     """
@@ -83,7 +92,8 @@ class HistoryOptions(dict):
         "{filename}.csv", or a "{filename}.hdf5" file. Depending on the values,
         the `create_history` method creates the appropriate object.
         Occurrences of "{id}" in the file name are replaced by the `id`
-        upon creation of a history, if applicable.
+        upon creation of a history, if applicable. HDF5 files are kept open
+        during a run, so starts run in parallel need "{id}" in the name.
     """
 
     def __init__(self,
@@ -152,7 +162,9 @@ class HistoryOptions(dict):
             else:
                 return History(options=self)
 
-        storage_file = self.storage_file.replace("{id}", id)
+        storage_file = self.storage_file
+        if "{id}" in storage_file:
+            storage_file = storage_file.replace("{id}", id)
 
         _, type = os.path.splitext(storage_file)
 
@@ -168,11 +180,12 @@ class HistoryOptions(dict):
                 "is supported")
 
 
-class HistoryBase(abc.ABC):
-    """Abstract base class for history objects.
+class HistoryBase:
+    """Base class for history objects.
 
     Can be used as a dummy history, but does not implement any history
-    functionality.
+    functionality. Histories that record a trace override the
+    `get_*_trace` getters as a whole, operating on their storage directly.
     """
 
     def __len__(self):
@@ -236,17 +249,18 @@ class HistoryBase(abc.ABC):
 
     def get_x_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[np.ndarray], np.ndarray]:
+    ) -> np.ndarray:
         """Parameters.
 
         Takes as parameter an index or indices and returns corresponding trace
-        values. If only a single value is requested, the list is flattened.
+        values as an array with one row per index. If only a single value is
+        requested, the array is flattened.
         """
         raise NotImplementedError()
 
     def get_fval_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
+    ) -> Union[np.ndarray, float]:
         """Function values.
 
         Takes as parameter an index or indices and returns corresponding trace
@@ -296,7 +310,7 @@ class HistoryBase(abc.ABC):
 
     def get_chi2_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
+    ) -> Union[np.ndarray, float]:
         """Chi2 values.
 
         Takes as parameter an index or indices and returns corresponding trace
@@ -316,7 +330,7 @@ class HistoryBase(abc.ABC):
 
     def get_time_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
+    ) -> Union[np.ndarray, float]:
         """Cumulative execution times.
 
         Takes as parameter an index or indices and returns corresponding trace
@@ -341,6 +355,8 @@ class History(HistoryBase):
         self._n_res: int = 0
         self._n_sres: int = 0
         self._start_time = time.time()
+        # monotonic and high-resolution reference for the trace times
+        self._start_perf_counter = time.perf_counter()
 
         if options is None:
             options = HistoryOptions()
@@ -421,6 +437,15 @@ class MemoryHistory(History):
     """Tracks numbers of function evaluations and keeps an in-memory
     trace of function evaluations.
 
+    The trace is stored in one preallocated array per variable, which
+    grows geometrically when full and is trimmed on finalization.
+    Parameters, gradients, chi2 sensitivities and scalar values are stored
+    in float arrays, with NaN rows for values missing in an iteration. The
+    arrays of gradients and chi2 sensitivities are only allocated once a
+    first value has been recorded. Residuals, their sensitivities and
+    Hessians, whose shapes are not known in advance, are stored in object
+    arrays.
+
     Parameters
     ----------
     options:
@@ -430,10 +455,12 @@ class MemoryHistory(History):
     def __init__(self, options: Union[HistoryOptions, Dict] = None):
         super().__init__(options=options)
         self._trace_keys = {X, FVAL, GRAD, HESS, RES, SRES, CHI2, SCHI2, TIME}
-        self._trace: Dict[str, Any] = {key: [] for key in self._trace_keys}
+        # allocated on the first update, when the dimension is known
+        self._trace: Dict[str, np.ndarray] = {}
+        self._n_iterations: int = 0
 
     def __len__(self):
-        return len(self._trace[TIME])
+        return self._n_iterations
 
     def update(
             self,
@@ -445,68 +472,115 @@ class MemoryHistory(History):
         super().update(x, sensi_orders, mode, result)
         self._update_trace(x, mode, result)
 
+    def finalize(self):
+        """Finalize history. Called after a run."""
+        super().finalize()
+        # release the unused capacity
+        for key, values in self._trace.items():
+            self._trace[key] = values[:self._n_iterations].copy()
+
     def _update_trace(self, x, mode, result):
         """Update internal trace representation."""
+        if not self._trace:
+            self._init_trace(x)
+        elif self._n_iterations == len(self._trace[TIME]):
+            self._grow_trace()
+
         ret = extract_values(mode, result, self.options)
-        for key in self._trace_keys - {X, TIME}:
-            self._trace[key].append(ret[key])
-        used_time = time.time() - self._start_time
-        self._trace[X].append(x)
-        self._trace[TIME].append(used_time)
+        ret[X] = x
+        ret[TIME] = time.perf_counter() - self._start_perf_counter
+        for key in [GRAD, SCHI2]:
+            if key not in self._trace and ret.get(key) is not None:
+                # earlier iterations did not record a value
+                self._trace[key] = np.full(
+                    (len(self._trace[TIME]), *np.shape(x)), np.NaN)
+        for key in self._trace_keys & self._trace.keys():
+            self._trace[key][self._n_iterations] = ret.get(key, np.NaN)
+        self._n_iterations += 1
+
+    def _init_trace(self, x: np.ndarray, capacity: int = 100):
+        """Allocate the trace arrays, except for gradients and chi2
+        sensitivities."""
+        self._trace = {
+            key: np.empty(capacity, dtype=object)
+            for key in [HESS, RES, SRES]
+        }
+        self._trace[X] = np.empty((capacity, *np.shape(x)))
+        for key in [FVAL, CHI2, TIME]:
+            self._trace[key] = np.empty(capacity)
+
+    def _grow_trace(self):
+        """Double the capacity of the trace arrays."""
+        for key, values in self._trace.items():
+            grown = np.empty((2 * len(values), *values.shape[1:]),
+                             dtype=values.dtype)
+            grown[:len(values)] = values
+            self._trace[key] = grown
+
+    def _get_trace(self, key: str, ix: np.ndarray) -> np.ndarray:
+        """Get the trace entries `ix` of variable `key`."""
+        if not self._trace:
+            return np.empty(0)[ix]
+        if key not in self._trace:
+            # no gradient or chi2 sensitivity recorded yet
+            return np.full((self._n_iterations, *self._trace[X].shape[1:]),
+                           np.NaN)[ix]
+        # only the first entries of the preallocated arrays are filled
+        return self._trace[key][:self._n_iterations][ix]
 
     @trace_wrap
     def get_x_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[np.ndarray], np.ndarray]:
-        return [self._trace[X][i] for i in ix]
+    ) -> np.ndarray:
+        return self._get_trace(X, ix)
 
     @trace_wrap
     def get_fval_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
-        return [self._trace[FVAL][i] for i in ix]
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace(FVAL, ix)
 
     @trace_wrap
     def get_grad_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return [self._trace[GRAD][i] for i in ix]
+        return self._get_trace(GRAD, ix)
 
     @trace_wrap
     def get_hess_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return [self._trace[HESS][i] for i in ix]
+        return list(self._get_trace(HESS, ix))
 
     @trace_wrap
     def get_res_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return [self._trace[RES][i] for i in ix]
+        return list(self._get_trace(RES, ix))
 
     @trace_wrap
     def get_sres_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return [self._trace[SRES][i] for i in ix]
+        return list(self._get_trace(SRES, ix))
 
     @trace_wrap
     def get_chi2_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
-        return [self._trace[CHI2][i] for i in ix]
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace(CHI2, ix)
 
     @trace_wrap
     def get_schi2_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return [self._trace[SCHI2][i] for i in ix]
+        return self._get_trace(SCHI2, ix)
 
     @trace_wrap
     def get_time_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
-        return [self._trace[TIME][i] for i in ix]
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace(TIME, ix)
 
 
 class CsvHistory(History):
@@ -532,6 +606,15 @@ class CsvHistory(History):
         super().__init__(options=options)
         self.x_names = x_names
         self._trace: Union[pd.DataFrame, None] = None
+        # rows recorded since the last save, and data frames of the rows
+        # saved since the trace data frame was last consolidated
+        self._trace_buffer: List[List[Any]] = []
+        self._trace_chunks: List[pd.DataFrame] = []
+        self._n_rows: int = 0
+        # rows already written to the file
+        self._n_rows_saved: int = 0
+        # positions of the trace columns of each variable
+        self._column_positions: Dict[str, Union[int, slice]] = {}
         self.file = os.path.abspath(file)
 
         # create trace file dirs
@@ -547,16 +630,19 @@ class CsvHistory(History):
             trace.columns = pd.MultiIndex.from_tuples(
                 cols.to_records(index=False).tolist()
             )
-            for col in trace.columns:
+            for col in trace.columns[trace.dtypes == object]:
                 # transform strings to np.ndarrays
-                trace[col] = trace[col].apply(string2ndarray)
+                trace[col] = trace[col].map(string2ndarray)
 
             self._trace = trace
+            self._n_rows = len(trace)
+            self._n_rows_saved = len(trace)
             self.x_names = trace[X].columns
+            self._init_column_positions()
             self._update_counts_from_trace()
 
     def __len__(self):
-        return len(self._trace)
+        return self._n_rows
 
     def _update_counts_from_trace(self):
         self._n_fval = self._trace[('n_fval', np.NaN)].max()
@@ -579,6 +665,7 @@ class CsvHistory(History):
         """Finalize history. Called after a run."""
         super().finalize()
         self._save_trace(finalize=True)
+        self._consolidate_trace()
 
     def _update_trace(self,
                       x: np.ndarray,
@@ -597,37 +684,34 @@ class CsvHistory(History):
         # extract function values
         ret = extract_values(mode, result, self.options)
 
-        used_time = time.time() - self._start_time
-
-        # create table row
-        row = pd.Series(name=len(self._trace),
-                        index=self._trace.columns,
-                        dtype='object')
-
-        values = {
-            TIME: used_time,
-            N_FVAL: self._n_fval,
-            N_GRAD: self._n_grad,
-            N_HESS: self._n_hess,
-            N_RES: self._n_res,
-            N_SRES: self._n_sres,
-            FVAL: ret[FVAL],
-            RES: ret[RES],
-            SRES: ret[SRES],
-            CHI2: ret[CHI2],
-            HESS: ret[HESS],
-        }
+        used_time = time.perf_counter() - self._start_perf_counter
+
+        # create table row, in the order of the trace columns
+        row = [
+            used_time,
+            self._n_fval,
+            self._n_grad,
+            self._n_hess,
+            self._n_res,
+            self._n_sres,
+            ret.get(FVAL, np.NaN),
+            ret.get(CHI2, np.NaN),
+            ret.get(RES, np.NaN),
+            ret.get(SRES, np.NaN),
+            ret.get(HESS, np.NaN),
+        ]
 
-        for var, val in values.items():
-            row[(var, float('nan'))] = val
+        # variables that are not recorded have a single NaN column, and are
+        # not contained in ret
+        for var, val in ((X, x),
+                         (GRAD, ret.get(GRAD, np.NaN)),
+                         (SCHI2, ret.get(SCHI2, np.NaN))):
+            cols = self._column_positions[var]
+            row.extend(np.broadcast_to(val, (cols.stop - cols.start,)))
 
-        for var, val in {X: x, GRAD: ret[GRAD], SCHI2: ret[SCHI2]}.items():
-            if var == X or self.options[f'trace_record_{var}']:
-                row[var] = val
-            else:
-                row[(var, float('nan'))] = np.NaN
-
-        self._trace = self._trace.append(row)
+        # appending to the data frame copies it, so only buffer the row here
+        self._trace_buffer.append(row)
+        self._n_rows += 1
 
         # save trace to file
         self._save_trace()
@@ -639,119 +723,192 @@ class CsvHistory(History):
         if self.x_names is None:
             self.x_names = [f'x{i}' for i, _ in enumerate(x)]
 
-        columns: List[Tuple] = [
-            (c, float('nan')) for c in [
-                TIME, N_FVAL, N_GRAD, N_HESS, N_RES, N_SRES,
-                FVAL, CHI2, RES, SRES, HESS,
-            ]
-        ]
+        columns, dtypes = _csv_trace_schema(
+            tuple(self.x_names),
+            self.options.trace_record_grad,
+            self.options.trace_record_schi2,
+        )
+        self._trace = pd.DataFrame(columns=columns, dtype='float64') \
+            .astype(dtypes)
+        self._init_column_positions()
 
-        for var in [X, GRAD, SCHI2]:
-            if var == 'x' or self.options[f'trace_record_{var}']:
-                columns.extend([
-                    (var, x_name)
-                    for x_name in self.x_names
-                ])
+    def _init_column_positions(self):
+        """
+        Cache the positions of the trace columns of each variable, so that
+        the getters can index the underlying arrays directly.
+        """
+        var_columns = self._trace.columns.get_level_values(0)
+        for var in [X, FVAL, GRAD, HESS, RES, SRES, CHI2, SCHI2, TIME]:
+            pos = np.flatnonzero(var_columns == var)
+            if var in [X, GRAD, SCHI2]:
+                self._column_positions[var] = slice(int(pos[0]),
+                                                    int(pos[-1]) + 1)
             else:
-                columns.extend([(var,)])
-
-        # TODO: multi-index for res, sres, hess
-        self._trace = pd.DataFrame(columns=pd.MultiIndex.from_tuples(columns),
-                                   dtype='float64')
-
-        # only non-float64
-        trace_dtypes = {
-            RES: 'object',
-            SRES: 'object',
-            HESS: 'object',
-            N_FVAL: 'int64',
-            N_GRAD: 'int64',
-            N_HESS: 'int64',
-            N_RES: 'int64',
-            N_SRES: 'int64',
-        }
-
-        for var, dtype in trace_dtypes.items():
-            self._trace[(var, np.NaN)] = \
-                self._trace[(var, np.NaN)].astype(dtype)
+                self._column_positions[var] = int(pos[0])
 
     def _save_trace(self, finalize: bool = False):
         """
         Save to file via pd.DataFrame.to_csv() if `self.storage_file` is
         not None and other conditions apply.
+
+        The file is written with header on the first save, afterwards only
+        the rows recorded since the last save are appended. The trace data
+        frame is not touched, so a save costs time proportional to the
+        number of new rows.
         """
-        if self.file is None:
+        if self.file is None or self._trace is None:
             return
 
         if finalize \
-                or (len(self._trace) > 0 and len(self._trace) %
+                or (len(self) > 0 and len(self) %
                     self.options.trace_save_iter == 0):
-            # save
-            trace_copy = copy.deepcopy(self._trace)
+            self._flush_trace_buffer()
+            if self._n_rows_saved == 0:
+                # write the header, also for an empty trace
+                mode, header = 'w', True
+            elif self._n_rows_saved < len(self):
+                mode, header = 'a', False
+            else:
+                return
+            rows = self._get_trace_tail(len(self) - self._n_rows_saved)
+            # convert the array columns. The rows are a deep copy, assigning
+            # to a shallow one may modify the trace in place
             for field in [('hess', np.NaN), ('res', np.NaN), ('sres', np.NaN)]:
-                trace_copy[field] = trace_copy[field].apply(
-                    ndarray2string_full
-                )
-            trace_copy.to_csv(self.file)
+                rows[field] = rows[field].map(ndarray2string_base64)
+            rows.to_csv(self.file, mode=mode, header=header)
+            self._n_rows_saved = len(self)
+
+    def _flush_trace_buffer(self):
+        """
+        Turn the buffered rows into a data frame chunk.
+        """
+        if not self._trace_buffer:
+            return
+
+        n_rows_chunk = len(self._trace_buffer)
+        self._trace_chunks.append(pd.DataFrame(
+            self._trace_buffer,
+            index=pd.RangeIndex(self._n_rows - n_rows_chunk, self._n_rows),
+            columns=self._trace.columns,
+        ).astype(self._trace.dtypes))
+        self._trace_buffer = []
+
+    def _get_trace_tail(self, n_rows: int) -> pd.DataFrame:
+        """
+        Copy of the last `n_rows` rows of the trace data frame and its
+        chunks. Buffered rows must have been flushed before. Empty if no
+        trace has been initialized yet.
+        """
+        if self._trace is None:
+            return pd.DataFrame()
+
+        frames = []
+        for frame in reversed([self._trace, *self._trace_chunks]):
+            if n_rows <= 0 and frames:
+                break
+            frames.append(frame.iloc[max(0, len(frame) - n_rows):])
+            n_rows -= len(frame)
+        if len(frames) > 1:
+            return pd.concat(frames[::-1])
+        return frames[0].copy()
+
+    def _consolidate_trace(self):
+        """
+        Append all buffered rows and chunks to the trace data frame at once.
+        """
+        self._flush_trace_buffer()
+        if not self._trace_chunks:
+            return
+
+        self._trace = pd.concat([self._trace, *self._trace_chunks])
+        self._trace_chunks = []
+
+    def _get_trace_values(self,
+                          var: str,
+                          ix: Union[int, Sequence[int], None]) -> np.ndarray:
+        """
+        Get the trace values of `var` at `ix` as array.
+        """
+        self._consolidate_trace()
+        return self._trace.iloc[:, self._column_positions[var]].values[ix]
 
     @trace_wrap
     def get_x_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[np.ndarray], np.ndarray]:
-        return list(self._trace[X].values[ix])
+    ) -> np.ndarray:
+        return self._get_trace_values(X, ix)
 
     @trace_wrap
     def get_fval_trace(
             self, ix: Union[int, Sequence[int], None]
-    ) -> Union[Sequence[float], float]:
-        return list(self._trace[(FVAL, np.nan)].values[ix])
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace_values(FVAL, ix)
 
     @trace_wrap
     def get_grad_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return list(self._trace[GRAD].values[ix])
+        return self._get_trace_values(GRAD, ix)
 
     @trace_wrap
     def get_hess_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return list(self._trace[(HESS, np.nan)].values[ix])
+        return list(self._get_trace_values(HESS, ix))
 
     @trace_wrap
     def get_res_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return list(self._trace[(RES, np.nan)].values[ix])
+        return list(self._get_trace_values(RES, ix))
 
     @trace_wrap
     def get_sres_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return list(self._trace[(SRES, np.nan)].values[ix])
+        return list(self._get_trace_values(SRES, ix))
 
     @trace_wrap
     def get_chi2_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
-        return list(self._trace[(CHI2, np.nan)].values[ix])
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace_values(CHI2, ix)
 
     @trace_wrap
     def get_schi2_trace(
             self, ix: Union[int, Sequence[int], None] = None
     ) -> Union[Sequence[MaybeArray], MaybeArray]:
-        return list(self._trace[SCHI2].values[ix])
+        return self._get_trace_values(SCHI2, ix)
 
     @trace_wrap
     def get_time_trace(
             self, ix: Union[int, Sequence[int], None] = None
-    ) -> Union[Sequence[float], float]:
-        return list(self._trace[(TIME, np.nan)].values[ix])
+    ) -> Union[np.ndarray, float]:
+        return self._get_trace_values(TIME, ix)
 
 
 class Hdf5History(History):
     """Stores a representation of the history in an HDF5 file.
 
+    The file is opened on the first write and kept open until the history
+    is finalized, instead of being reopened on every function evaluation.
+    Trace values are buffered in memory, and written together with the
+    counters every `trace_save_iter` updates and on finalization, and then
+    flushed to disk. Saving more often is safer, but slower. If the
+    history is not finalized, this happens when it is deleted. It can also
+    be used as a context manager, which finalizes it on exit.
+
+    As the file stays open and locked during a run, histories that are
+    recorded in parallel, e.g. by multistarts with a
+    :class:`pypesto.engine.MultiProcessEngine`, need separate files, i.e.
+    "{id}" in the `storage_file` name.
+
+    Each trace variable is stored in a single resizable dataset with one row
+    per iteration under `/optimization/results/{id}/trace/`. The datasets
+    are chunked, array-valued ones also shuffled+compressed, and only
+    created once a first value for the variable has been recorded. Missing
+    entries are NaN.
+
     Parameters
     ----------
     id:
@@ -769,6 +926,29 @@ class Hdf5History(History):
         super().__init__(options=options)
         self.id = id
         self.file = file
+        self._trace_path: str = f'/optimization/results/{id}/trace'
+        self._f: Union[h5py.File, None] = None
+        self._trace_grp: Union[h5py.Group, None] = None
+        # keep the datasets open, closing them flushes their chunk cache
+        self._trace_dsets: Dict[str, h5py.Dataset] = {}
+        self._trace_initialized: bool = False
+        # (iteration, value) pairs per variable not yet written to the file
+        self._trace_buffer: Dict[str, List[Tuple[int, MaybeArray]]] = {}
+        # full traces read from the file, with the trace length at reading
+        self._trace_cache: Dict[str, Tuple[int, np.ndarray]] = {}
+        self._n_iterations: int = 0
+
+    def __len__(self):
+        return self._n_iterations
+
+    def __getstate__(self):
+        # h5py objects cannot be pickled, the file is reopened on demand
+        state = self.__dict__.copy()
+        state['_f'] = None
+        state['_trace_grp'] = None
+        state['_trace_dsets'] = {}
+        state['_trace_cache'] = {}
+        return state
 
     def update(
             self,
@@ -777,12 +957,278 @@ class Hdf5History(History):
             mode: str,
             result: ResultDict
     ) -> None:
-        # TODO implement
-        raise NotImplementedError()
+        super().update(x, sensi_orders, mode, result)
+        self._update_trace(x, mode, result)
+        self._n_iterations += 1
+        if self._n_iterations % self.options.trace_save_iter == 0:
+            self._flush_trace()
+            self._write_counts()
+            # make the saved values durable, e.g. if the process is killed
+            self._f.flush()
 
     def finalize(self):
-        # TODO implement
-        raise NotImplementedError()
+        """Finalize history. Called after a run."""
+        super().finalize()
+        self._flush_trace()
+        self._write_counts()
+        # pad all datasets to the full trace length
+        for dset in self._trace_dsets.values():
+            dset.resize(self._n_iterations, axis=0)
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finalize()
+
+    def __del__(self):
+        # write buffered values and release the file if not finalized
+        if getattr(self, '_f', None) is not None \
+                or getattr(self, '_trace_buffer', None):
+            self._flush_trace()
+            self._close()
+
+    def _update_trace(self,
+                      x: np.ndarray,
+                      mode: str,
+                      result: ResultDict):
+        """
+        Buffer the values of the current iteration for the trace datasets.
+        """
+        if not self.options.trace_record:
+            return
+
+        ret = extract_values(mode, result, self.options)
+
+        used_time = time.perf_counter() - self._start_perf_counter
+
+        # missing values are not written, the datasets are NaN-filled
+        values = {
+            var: val
+            for var, val in ret.items()
+            if val is not None
+        }
+        values[X] = x
+        values[TIME] = used_time
+
+        for var, val in values.items():
+            self._trace_buffer.setdefault(var, []).append(
+                (self._n_iterations, val))
+
+    def _flush_trace(self):
+        """
+        Write the buffered trace values, with a single write per variable.
+        """
+        if not self._trace_buffer:
+            return
+
+        self._open()
+        for var, entries in self._trace_buffer.items():
+            iterations, vals = zip(*entries)
+            start = iterations[0]
+            if var not in self._trace_dsets:
+                self._create_trace_dataset(var, np.shape(vals[0]))
+            # rows of iterations without a value stay NaN
+            block = np.full((self._n_iterations - start, *np.shape(vals[0])),
+                            np.NaN)
+            block[np.asarray(iterations) - start] = vals
+            dset = self._trace_dsets[var]
+            dset.resize(self._n_iterations, axis=0)
+            dset[start:] = block
+        self._trace_buffer = {}
+
+    def _create_trace_dataset(self, var: str, shape: Tuple[int, ...]):
+        """
+        Create a resizable dataset for trace variable `var`. Array-valued
+        variables are shuffled and compressed, with chunks of about 1 MB.
+        For scalars the filters cost more than they save, but uncompressed
+        chunks are allocated in full, so they get chunks of 8 kB.
+        """
+        compress = len(shape) > 0
+        if compress:
+            n_rows_chunk = max(1, 2**20 // (8 * int(np.prod(shape))))
+        else:
+            n_rows_chunk = 2**10
+        self._trace_dsets[var] = self._trace_grp.create_dataset(
+            var,
+            shape=(self._n_iterations, *shape),
+            maxshape=(None, *shape),
+            chunks=(n_rows_chunk, *shape),
+            dtype='f8',
+            fillvalue=np.NaN,
+            shuffle=compress,
+            compression='lzf' if compress else None,
+        )
+
+    def _open(self):
+        """
+        Open the file and the trace group, unless already open.
+        """
+        if self._f is not None:
+            return
+
+        # create file dirs
+        dirname = os.path.dirname(os.path.abspath(self.file))
+        os.makedirs(dirname, exist_ok=True)
+
+        # the default file format, as files written in the HDF5 1.10 format
+        # keep their consistency flags set after a crash, and cannot be
+        # opened without h5clear
+        self._f = h5py.File(self.file, 'a', **HDF5_CHUNK_CACHE)
+        # replace a trace previously stored under the same id
+        if not self._trace_initialized and self._trace_path in self._f:
+            del self._f[self._trace_path]
+        self._trace_grp = self._f.require_group(self._trace_path)
+        self._trace_dsets = dict(self._trace_grp.items())
+        self._trace_initialized = True
+
+    def _close(self):
+        """
+        Close the file, if open.
+        """
+        if self._f is None:
+            return
+
+        self._f.close()
+        self._f = None
+        self._trace_grp = None
+        self._trace_dsets = {}
+
+    def _write_counts(self):
+        """
+        Write the counters and the number of iterations to the trace group
+        attributes.
+        """
+        self._open()
+        attrs = self._trace_grp.attrs
+        attrs[N_FVAL] = self._n_fval
+        attrs[N_GRAD] = self._n_grad
+        attrs[N_HESS] = self._n_hess
+        attrs[N_RES] = self._n_res
+        attrs[N_SRES] = self._n_sres
+        attrs[N_ITERATIONS] = self._n_iterations
+
+    def _get_hdf5_entries(self, var: str, ix: np.ndarray) -> np.ndarray:
+        """
+        Read the entries `ix` of trace variable `var` with one dataset read.
+        Entries that were not recorded are NaN. Full traces are cached until
+        the history is updated, other entries are read from the file.
+        """
+        n_cached, data = self._trace_cache.get(var, (None, None))
+        if n_cached == len(self):
+            return data[ix]
+
+        # raises for invalid indices, and resolves negative ones
+        ix = np.arange(len(self))[ix]
+        full = np.array_equal(ix, np.arange(len(self)))
+
+        if not self._trace_initialized and not self._trace_buffer:
+            # nothing written yet, the file may not exist or hold the trace
+            # of a previous run under the same id
+            return np.full(len(ix), np.NaN)
+
+        self._flush_trace()
+        if self._f is not None:
+            data = self._read_trace_dataset(self._trace_dsets.get(var), ix,
+                                            full)
+        else:
+            with h5py.File(self.file, 'r', **HDF5_CHUNK_CACHE) as f:
+                data = self._read_trace_dataset(
+                    f.get(f'{self._trace_path}/{var}'), ix, full)
+
+        if full:
+            self._trace_cache[var] = (len(self), data)
+            # the cached array must not be modified by the caller
+            return data.copy()
+        return data
+
+    @staticmethod
+    def _read_trace_dataset(dset: Union[h5py.Dataset, None],
+                            ix: np.ndarray,
+                            full: bool) -> np.ndarray:
+        """
+        Read the rows `ix` of trace dataset `dset`, or all rows if `full`.
+        Indices must be valid and non-negative. Rows of missing datasets,
+        and beyond their length, are NaN, as datasets are only padded to the
+        full length on finalization.
+        """
+        if dset is None:
+            return np.full(len(ix), np.NaN)
+
+        if full:
+            data = dset[()]
+            if len(data) < len(ix):
+                padding = np.full((len(ix) - len(data), *data.shape[1:]),
+                                  np.NaN)
+                data = np.concatenate([data, padding])
+            return data
+
+        # h5py requires increasing indices
+        rows, inverse = np.unique(ix, return_inverse=True)
+        data = np.full((len(rows), *dset.shape[1:]), np.NaN)
+        n_stored = int(np.searchsorted(rows, len(dset)))
+        if n_stored == 0:
+            pass
+        elif rows[n_stored - 1] - rows[0] + 1 == n_stored:
+            data[:n_stored] = dset[rows[0]:rows[n_stored - 1] + 1]
+        else:
+            data[:n_stored] = dset[rows[:n_stored]]
+        return data[inverse]
+
+    @trace_wrap
+    def get_x_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> np.ndarray:
+        return self._get_hdf5_entries(X, ix)
+
+    @trace_wrap
+    def get_fval_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[np.ndarray, float]:
+        return self._get_hdf5_entries(FVAL, ix)
+
+    @trace_wrap
+    def get_grad_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[Sequence[MaybeArray], MaybeArray]:
+        return self._get_hdf5_entries(GRAD, ix)
+
+    @trace_wrap
+    def get_hess_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[Sequence[MaybeArray], MaybeArray]:
+        return self._get_hdf5_entries(HESS, ix)
+
+    @trace_wrap
+    def get_res_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[Sequence[MaybeArray], MaybeArray]:
+        return self._get_hdf5_entries(RES, ix)
+
+    @trace_wrap
+    def get_sres_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[Sequence[MaybeArray], MaybeArray]:
+        return self._get_hdf5_entries(SRES, ix)
+
+    @trace_wrap
+    def get_chi2_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[np.ndarray, float]:
+        return self._get_hdf5_entries(CHI2, ix)
+
+    @trace_wrap
+    def get_schi2_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[Sequence[MaybeArray], MaybeArray]:
+        return self._get_hdf5_entries(SCHI2, ix)
+
+    @trace_wrap
+    def get_time_trace(
+            self, ix: Union[int, Sequence[int], None] = None
+    ) -> Union[np.ndarray, float]:
+        return self._get_hdf5_entries(TIME, ix)
 
 
 class OptimizerHistory:
@@ -858,19 +1304,16 @@ class OptimizerHistory:
         """
         Update initial and best function values.
         """
-        # update initial point
-        if np.allclose(x, self.x0):
-            if self.fval0 is None:
-                self.fval0 = result.get(FVAL, None)
+        fval, grad, hess, res, sres = (
+            result.get(var, None) for var in (FVAL, GRAD, HESS, RES, SRES))
+
+        # update initial point with the first evaluation close to it that
+        # returns a function value, later close points do not replace it
+        if self.fval0 is None and np.allclose(x, self.x0):
+            self.fval0 = fval
             self.x0 = x
 
         # update best point
-        fval = result.get(FVAL, None)
-        grad = result.get(GRAD, None)
-        hess = result.get(HESS, None)
-        res = result.get(RES, None)
-        sres = result.get(SRES, None)
-
         if fval is not None and fval < self.fval_min:
             self.fval_min = fval
             self.x_min = x
@@ -881,7 +1324,7 @@ class OptimizerHistory:
 
         # sometimes sensitivities are evaluated on subsequent calls. We can
         # identify this situation by checking that x hasn't changed
-        if np.all(self.x_min == x):
+        if self.x_min is x or np.array_equal(self.x_min, x):
             if self.grad_min is None and grad is not None:
                 self.grad_min = grad
             if self.hess_min is None and hess is not None:
@@ -892,49 +1335,113 @@ class OptimizerHistory:
                 self.sres_min = sres
 
     def _compute_vals_from_trace(self):
+        # read the scalar and x traces only once, and only the entries
+        # needed of the potentially large res, grad, sres and hess traces
+        options = self.history.options
+        record = {
+            var: getattr(options, f'trace_record_{var}')
+            for var in ['res', 'grad', 'sres', 'hess']
+        }
+        traces = {
+            var: getattr(self.history, f'get_{var}_trace')()
+            for var in ['fval', 'chi2', 'x']
+        }
+        for var in ['fval', 'x']:
+            traces[var] = np.asarray(traces[var], dtype=np.float64)
+
         # some optimizers may evaluate hess+grad first to compute trust region
         # etc
         max_init_iter = 3
-        for it in range(min(len(self.history), max_init_iter)):
-            candidate = self.history.get_fval_trace(it)
-            if not np.isnan(candidate) \
-                    and np.allclose(self.history.get_x_trace(it), self.x0):
-                self.fval0 = candidate
-                break
+        fvals_init = traces['fval'][:max_init_iter]
+        is_init = ~np.isnan(fvals_init) \
+            & np.isclose(traces['x'][:max_init_iter], self.x0).all(axis=1)
+        if is_init.any():
+            self.fval0 = fvals_init[is_init.argmax()]
 
-        # we prioritize fval over chi2 as fval is written whenever possible
-        ix_min = np.nanargmin(self.history.get_fval_trace())
-        # np.argmin returns ndarray when multiple minimal values are found, we
-        # generally want the first occurence
-        if isinstance(ix_min, np.ndarray):
-            ix_min = ix_min[0]
+        # we prioritize fval over chi2 as fval is written whenever possible.
+        # np.nanargmin returns the first occurrence of multiple minima
+        ix_min = int(np.nanargmin(traces['fval']))
 
         for var in ['fval', 'chi2', 'x']:
-            self.extract_from_history(var, ix_min)
+            self.extract_from_history(var, ix_min, traces[var])
 
-        if self.history.options.trace_record_res:
+        if record['res']:
             self.extract_from_history('res', ix_min)
 
         for var in ['grad', 'sres', 'hess']:
             target = f'{var}_min'  # attribute in self we want to set
             ix_try = ix_min + 1  # index we try after ix_min doesnt work
-            if getattr(self.history.options, f'trace_record_{var}'):
+            if record[var]:
                 self.extract_from_history(var, ix_min)
                 if getattr(self, target) is None \
                         and ix_try < len(self.history) \
-                        and np.allclose(self.history.get_x_trace(ix_min),
-                                        self.history.get_x_trace(ix_try)):
+                        and np.allclose(traces['x'][ix_min],
+                                        traces['x'][ix_try]):
                     # gradient/sres typically evaluated on the next call
                     # so we check if x remains the same and if yes try to
                     # extract from the next
                     self.extract_from_history(var, ix_try)
 
-    def extract_from_history(self, var, ix):
-        val = getattr(self.history, f'get_{var}_trace')(ix)
+    def extract_from_history(self, var, ix, trace=None):
+        """
+        Set the `{var}_min` attribute to entry `ix` of the `var` trace,
+        unless it is NaN. If given, the entry is taken from the full trace
+        `trace` instead of being read from the history.
+        """
+        if trace is None:
+            val = getattr(self.history, f'get_{var}_trace')(ix)
+        else:
+            val = trace[ix]
         if not np.all(np.isnan(val)):
             setattr(self, f'{var}_min', val)
 
 
+@functools.lru_cache(maxsize=None)
+def _csv_trace_schema(
+        x_names: Tuple[str, ...],
+        trace_record_grad: bool,
+        trace_record_schi2: bool,
+) -> Tuple[pd.MultiIndex, Dict[Tuple, str]]:
+    """
+    Columns and non-float64 column dtypes of the `CsvHistory` trace.
+    Cached, as all starts of a multistart optimization share them.
+    """
+    columns: List[Tuple] = [
+        (c, float('nan')) for c in [
+            TIME, N_FVAL, N_GRAD, N_HESS, N_RES, N_SRES,
+            FVAL, CHI2, RES, SRES, HESS,
+        ]
+    ]
+
+    for var, record in [(X, True), (GRAD, trace_record_grad),
+                        (SCHI2, trace_record_schi2)]:
+        if record:
+            columns.extend([
+                (var, x_name)
+                for x_name in x_names
+            ])
+        else:
+            columns.extend([(var,)])
+
+    # TODO: multi-index for res, sres, hess
+    columns = pd.MultiIndex.from_tuples(columns)
+
+    # only non-float64
+    trace_dtypes = {
+        RES: 'object',
+        SRES: 'object',
+        HESS: 'object',
+        N_FVAL: 'int64',
+        N_GRAD: 'int64',
+        N_HESS: 'int64',
+        N_RES: 'int64',
+        N_SRES: 'int64',
+    }
+    dtypes = {(var, np.NaN): dtype for var, dtype in trace_dtypes.items()}
+
+    return columns, dtypes
+
+
 def ndarray2string_full(x: Union[np.ndarray, None]) -> Union[str, None]:
     """
     Helper function that converts numpy arrays to string with 16 digit
@@ -956,9 +1463,33 @@ def ndarray2string_full(x: Union[np.ndarray, None]) -> Union[str, None]:
                            max_line_width=np.inf)
 
 
+def ndarray2string_base64(x: Union[np.ndarray, None]) -> Union[str, None]:
+    """
+    Helper function that converts numpy arrays losslessly to string, as
+    dtype, shape and the base64 encoded raw data, e.g. '<f8:2,3:AAAA...'
+
+    Parameters
+    ----------
+    x:
+        array to convert
+
+    Returns
+    -------
+    x:
+        array as string
+    """
+    if not isinstance(x, np.ndarray):
+        return x
+    shape = ','.join(str(n) for n in x.shape)
+    data = base64.b64encode(np.ascontiguousarray(x).tobytes()).decode('ascii')
+    return f'{x.dtype.str}:{shape}:{data}'
+
+
 def string2ndarray(x: Union[str, float]) -> Union[np.ndarray, float]:
     """
-    Helper function that converts string to numpy arrays
+    Helper function that converts string to numpy arrays. Accepts strings
+    created by :func:`ndarray2string_base64`, and by
+    :func:`ndarray2string_full` as written by earlier versions.
 
     Parameters
     ----------
@@ -972,6 +1503,11 @@ def string2ndarray(x: Union[str, float]) -> Union[np.ndarray, float]:
     """
     if not isinstance(x, str):
         return x
+    if not x.startswith('['):
+        dtype, shape, data = x.split(':')
+        return np.frombuffer(
+            bytearray(base64.b64decode(data)), dtype=dtype
+        ).reshape([int(n) for n in shape.split(',') if n])
     if x.startswith('[['):
         return np.vstack([
             np.fromstring(xx, sep=' ')
@@ -984,37 +1520,49 @@ def string2ndarray(x: Union[str, float]) -> Union[np.ndarray, float]:
 def extract_values(mode: str,
                    result: ResultDict,
                    options: HistoryOptions) -> Dict:
-    """Extract values to record from result."""
-    ret = {}
-    ret_vars = [FVAL, GRAD, HESS, RES, SRES, CHI2, SCHI2]
-    for var in ret_vars:
-        if options.get(f'trace_record_{var}', True) and var in result:
-            ret[var] = result[var]
-
-    # write values that weren't set yet with alternative methods
+    """
+    Extract values to record from result. Values that are not available or
+    not to be recorded are not contained in the returned dict.
+    """
     if mode == MODE_RES:
-        res_result = result.get(RES, None)
-        sres_result = result.get(SRES, None)
-        chi2 = res_to_chi2(res_result)
+        return _extract_values_res(result, options)
+    return _extract_values_fun(result, options)
+
+
+def _extract_values_fun(result: ResultDict,
+                        options: HistoryOptions) -> Dict:
+    """Extract values to record from a result in function value mode."""
+    # only the few returned values need to be checked against the options
+    return {
+        var: val
+        for var, val in result.items()
+        if var in TRACE_VARS and options.get(f'trace_record_{var}', True)
+    }
+
+
+def _extract_values_res(result: ResultDict,
+                        options: HistoryOptions) -> Dict:
+    """Extract values to record from a result in residual mode."""
+    ret = _extract_values_fun(result, options)
+
+    # write values that weren't set yet with alternative methods,
+    # computing only those that are missing and going to be recorded
+    res_result = result.get(RES, None)
+    sres_result = result.get(SRES, None)
+    missing = {
+        var: var not in ret and options.get(f'trace_record_{var}', True)
+        for var in [CHI2, SCHI2, GRAD, HESS]
+    }
+    if missing[CHI2] and res_result is not None:
+        ret[CHI2] = res_to_chi2(res_result)
+    if (missing[SCHI2] or missing[GRAD]) \
+            and res_result is not None and sres_result is not None:
         schi2 = sres_to_schi2(res_result, sres_result)
-        fim = sres_to_fim(sres_result)
-        alt_values = {CHI2: chi2, SCHI2: schi2, HESS: fim}
-        if schi2 is not None:
-            alt_values[GRAD] = 0.5 * schi2
-
-        # filter according to options
-        alt_values = {
-            key: val
-            for key, val in alt_values.items()
-            if options.get(f'trace_record_{key}', True)
-        }
-        for var, val in alt_values.items():
-            if val is not None:
-                ret[var] = ret.get(var, val)
-
-    # set everything missing to NaN
-    for var in ret_vars:
-        if var not in ret:
-            ret[var] = np.NaN
+        if missing[SCHI2]:
+            ret[SCHI2] = schi2
+        if missing[GRAD]:
+            ret[GRAD] = 0.5 * schi2
+    if missing[HESS] and sres_result is not None:
+        ret[HESS] = sres_to_fim(sres_result)
 
     return ret
@@ -56,11 +56,20 @@ def history_decorator(minimize):
         objective.history = optimizer_history
 
         # perform the actual minimization
+        history_finalized = False
         try:
             result = minimize(self, problem, x0, id, history_options)
-            objective.history.finalize()
             result.id = id
+            history_finalized = True
+            objective.history.finalize()
         except Exception as err:
+            if not history_finalized:
+                # store what was recorded, without masking the error
+                try:
+                    objective.history.finalize()
+                except Exception as finalize_err:
+                    logger.error(f'start {id}: could not finalize history: '
+                                 f'{finalize_err}')
             if allow_failed_starts:
                 logger.error(f'start {id} failed: {err}')
                 result = OptimizerResult(
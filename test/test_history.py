@@ -3,15 +3,19 @@ This is for testing the pypesto.History.
 """
 
 import numpy as np
+import os
 import pytest
 import unittest
 import tempfile
+import h5py
 
 from test.test_objective import rosen_for_sensi
 from test.test_sbml_conversion import load_model_objective
 
 import pypesto
 from pypesto.objective.util import sres_to_schi2, res_to_chi2
+from pypesto.objective.history import (
+    ndarray2string_base64, ndarray2string_full, string2ndarray)
 from pypesto import CsvHistory, HistoryOptions, MemoryHistory, ObjectiveBase
 from pypesto.optimize.optimizer import read_result_from_file, OptimizerResult
 
@@ -132,7 +136,8 @@ class HistoryTest(unittest.TestCase):
             if not a.startswith('__')
             and not callable(getattr(start.history, a))
             and a not in ['options', '_abc_impl', '_start_time',
-                          'start_time', '_trace', 'x_names']
+                          '_start_perf_counter', 'start_time', '_trace',
+                          'x_names']
         ]
         for attr in history_attributes:
             assert getattr(start.history, attr) == \
@@ -392,13 +397,17 @@ class FunModeHistoryTest(HistoryTest):
         self.check_history()
 
 
-@pytest.fixture(params=["", "memory", "csv"])
+@pytest.fixture(params=["", "memory", "csv", "hdf5"])
 def history(request) -> pypesto.History:
     if request.param == "memory":
         history = pypesto.MemoryHistory(options={'trace_record': True})
     elif request.param == "csv":
         file = tempfile.mkstemp(suffix='.csv')[1]
         history = pypesto.CsvHistory(file, options={'trace_record': True})
+    elif request.param == "hdf5":
+        file = tempfile.mkstemp(suffix='.hdf5')[1]
+        history = pypesto.Hdf5History(id='0', file=file,
+                                      options={'trace_record': True})
     else:
         history = pypesto.History()
     for _ in range(10):
@@ -415,7 +424,7 @@ def test_history_properties(history: pypesto.History):
     assert history.n_res == 0
     assert history.n_sres == 0
 
-    if type(history) == pypesto.History:
+    if type(history) is pypesto.History:
         with pytest.raises(NotImplementedError):
             history.get_fval_trace()
     else:
@@ -423,9 +432,7 @@ def test_history_properties(history: pypesto.History):
         assert len(fvals) == 10
         assert all(np.isfinite(fvals))
 
-    if type(history) in \
-            (pypesto.History, pypesto.Hdf5History):
-        # TODO update as functionality is implemented
+    if type(history) is pypesto.History:
         with pytest.raises(NotImplementedError):
             history.get_grad_trace()
     else:
@@ -433,9 +440,8 @@ def test_history_properties(history: pypesto.History):
         assert len(grads) == 10
         assert len(grads[0]) == 7
 
-    if isinstance(history, (pypesto.MemoryHistory, pypesto.CsvHistory)):
-        # TODO extend as functionality is implemented in other histories
-
+    if isinstance(history, (pypesto.MemoryHistory, pypesto.CsvHistory,
+                            pypesto.Hdf5History)):
         # assert x values are not all the same
         xs = np.array(history.get_x_trace())
         assert np.all(xs[:-1] != xs[-1])
@@ -446,7 +452,8 @@ def test_history_properties(history: pypesto.History):
 
 def test_trace_subset(history: pypesto.History):
     """Test whether selecting only a trace subset works."""
-    if isinstance(history, (pypesto.MemoryHistory, pypesto.CsvHistory)):
+    if isinstance(history, (pypesto.MemoryHistory, pypesto.CsvHistory,
+                            pypesto.Hdf5History)):
         arr = list(range(0, len(history), 2))
 
         for var in ['fval', 'grad', 'hess', 'res', 'sres', 'chi2',
@@ -466,8 +473,12 @@ def test_trace_subset(history: pypesto.History):
                         and np.all(np.isnan(b))
 
             # check sequence type
-            assert isinstance(full_trace, Sequence)
-            assert isinstance(partial_trace, Sequence)
+            if var in ['fval', 'chi2', 'x', 'time']:
+                assert isinstance(full_trace, np.ndarray)
+                assert isinstance(partial_trace, np.ndarray)
+            else:
+                assert isinstance(full_trace, (Sequence, np.ndarray))
+                assert isinstance(partial_trace, (Sequence, np.ndarray))
 
             # check individual type
             val = getter(0)
@@ -475,3 +486,165 @@ def test_trace_subset(history: pypesto.History):
                 assert isinstance(val, float)
             else:
                 assert isinstance(val, np.ndarray) or np.isnan(val)
+
+
+def test_trace_index_bounds(history: pypesto.History):
+    """Test that only recorded entries can be indexed."""
+    if isinstance(history, (pypesto.MemoryHistory, pypesto.CsvHistory,
+                            pypesto.Hdf5History)):
+        n = len(history)
+        for var in ['fval', 'x', 'time']:
+            getter = getattr(history, f'get_{var}_trace')
+            assert np.array_equal(getter(-1), getter()[n - 1])
+            with pytest.raises(IndexError):
+                getter(n)
+
+
+def test_memory_history_allocation():
+    """Test that MemoryHistory only allocates what it records."""
+    history = pypesto.MemoryHistory(options={'trace_record': True})
+    for _ in range(3):
+        history.update(np.random.randn(7), (0,), 'mode_fun',
+                       {FVAL: np.random.randn()})
+    # no gradients or chi2 sensitivities recorded
+    assert GRAD not in history._trace and SCHI2 not in history._trace
+    assert history.get_grad_trace().shape == (3, 7)
+    assert np.all(np.isnan(history.get_grad_trace()))
+
+    history.update(np.random.randn(7), (0, 1), 'mode_fun',
+                   {FVAL: np.random.randn(), GRAD: np.ones(7)})
+    history.finalize()
+    # trimmed to the recorded entries
+    assert all(len(values) == 4 for values in history._trace.values())
+    assert np.all(np.isnan(history.get_grad_trace()[:3]))
+    assert np.array_equal(history.get_grad_trace(-1), np.ones(7))
+
+
+def test_hdf5_history():
+    """Test whether counters and trace are written to the HDF5 file."""
+    file = tempfile.mkstemp(suffix='.hdf5')[1]
+    history = pypesto.Hdf5History(
+        id='0', file=file, options={'trace_record': True})
+    xs = np.random.randn(11, 7)
+    for x in xs[:-1]:
+        result = {FVAL: np.random.randn(), GRAD: np.random.randn(7)}
+        history.update(x, (0, 1), 'mode_fun', result)
+    history.update(xs[-1], (0,), 'mode_fun', {FVAL: 0.})
+    history.finalize()
+
+    with h5py.File(file, 'r') as f:
+        trace = f['/optimization/results/0/trace']
+        assert trace.attrs['n_fval'] == history.n_fval == 11
+        assert trace.attrs['n_grad'] == history.n_grad == 10
+        assert trace.attrs['n_hess'] == history.n_hess == 0
+        assert trace.attrs['n_iterations'] == len(history) == 11
+
+        assert np.array_equal(trace['x'][:], xs)
+        assert trace['fval'].shape == (11,)
+        assert trace['grad'].shape == (11, 7)
+        assert np.all(np.isfinite(trace['grad'][:-1]))
+        assert np.all(np.isnan(trace['grad'][-1]))
+        # nothing recorded
+        assert 'res' not in trace
+        # short traces do not allocate full size chunks
+        for var in ['fval', 'time', 'x', 'grad']:
+            assert trace[var].id.get_storage_size() < 2**16
+
+
+def test_hdf5_history_value_types():
+    """Test that None and list values are accepted, as by the other
+    histories."""
+    file = tempfile.mkstemp(suffix='.hdf5')[1]
+    history = pypesto.Hdf5History(
+        id='0', file=file, options={'trace_record': True})
+    history.update(np.zeros(2), (0, 1), 'mode_fun',
+                   {FVAL: 1., GRAD: [1., 2.]})
+    history.update(np.ones(2), (0, 1), 'mode_fun', {FVAL: None, GRAD: None})
+    history.finalize()
+
+    assert np.array_equal(history.get_fval_trace(), [1., np.NaN],
+                          equal_nan=True)
+    assert np.array_equal(history.get_grad_trace(),
+                          [[1., 2.], [np.NaN, np.NaN]], equal_nan=True)
+
+
+def test_hdf5_history_reads():
+    """Test that traces are only read from the history's own records, and
+    that returned traces do not share memory with the history."""
+    file = tempfile.mkstemp(suffix='.hdf5')[1]
+    os.remove(file)
+    history = pypesto.Hdf5History(
+        id='0', file=file, options={'trace_record': True})
+    # no file yet
+    assert len(history.get_fval_trace()) == 0
+
+    for _ in range(5):
+        history.update(np.random.randn(7), (0,), 'mode_fun',
+                       {FVAL: np.random.randn()})
+    history.finalize()
+    fvals = history.get_fval_trace()
+    fvals[:] = -1
+    assert not np.any(history.get_fval_trace() == -1)
+
+    # the trace of a previous history with the same id is not read
+    history = pypesto.Hdf5History(
+        id='0', file=file, options={'trace_record': True})
+    assert len(history.get_fval_trace()) == 0
+    assert len(history.get_x_trace()) == 0
+
+
+def test_hdf5_history_cleanup():
+    """Test that buffered values are written without finalization."""
+    file = tempfile.mkstemp(suffix='.hdf5')[1]
+    with pypesto.Hdf5History(
+            id='0', file=file, options={'trace_record': True}) as history:
+        for _ in range(3):
+            history.update(np.random.randn(7), (0,), 'mode_fun',
+                           {FVAL: np.random.randn()})
+    with h5py.File(file, 'r') as f:
+        assert f['/optimization/results/0/trace/fval'].shape == (3,)
+
+    history = pypesto.Hdf5History(
+        id='1', file=file, options={'trace_record': True})
+    for i in range(4):
+        history.update(np.random.randn(7), (0,), 'mode_fun',
+                       {FVAL: np.random.randn()})
+        if i == 1:
+            # opens the file
+            history.get_fval_trace()
+    del history
+    # the file has been released
+    with h5py.File(file, 'a') as f:
+        assert f['/optimization/results/1/trace/fval'].shape == (4,)
+
+
+@pytest.mark.parametrize("trace_record", [True, False])
+def test_failed_starts_csv_history(trace_record):
+    """Test that starts failing before any evaluation are reported as
+    failed with a csv history."""
+    def fun(_):
+        raise Exception("This function cannot be called.")
+
+    problem = pypesto.Problem(pypesto.Objective(fun=fun), -1, 1)
+    history_options = HistoryOptions(
+        trace_record=trace_record,
+        storage_file=tempfile.mkdtemp() + '/trace_{id}.csv')
+
+    result = pypesto.optimize.minimize(
+        problem=problem,
+        optimizer=pypesto.optimize.ScipyOptimizer(),
+        n_starts=2,
+        options=pypesto.optimize.OptimizeOptions(allow_failed_starts=True),
+        history_options=history_options,
+    )
+    assert [start.exitflag for start in result.optimize_result.list] \
+        == [-1, -1]
+
+
+def test_ndarray_string_conversion():
+    """Test that arrays stored in csv histories are restored exactly."""
+    for x in [np.random.randn(5), np.random.randn(4, 3),
+              np.arange(6.).reshape(3, 2).T]:
+        assert np.array_equal(string2ndarray(ndarray2string_base64(x)), x)
+        # strings written by previous versions can still be read
+        assert np.allclose(string2ndarray(ndarray2string_full(x)), x)